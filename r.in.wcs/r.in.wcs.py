@@ -82,11 +82,28 @@
 # % label: Maximum number of download retries
 # %end
 
+# %option
+# % key: compression
+# % type: string
+# % required: no
+# % multiple: no
+# % options: none,Deflate,LZW,PackBits
+# % answer: Deflate
+# % label: Compression of the downloaded tifs
+# % description: Requested via the GeoTIFF extension of WCS 2.0; if the server rejects it, the tifs are requested uncompressed
+# %end
+
 # %option G_OPT_M_NPROCS
 # % description: Number of cores for multiprocessing, -2 is the number of available cores - 1
 # % answer: -2
 # %end
 
+# %flag
+# % key: a
+# % label: Download the tiles asynchronously
+# % description: The tiles are downloaded with asyncio and aiohttp in one thread instead of a thread pool; requires aiohttp and aiofiles
+# %end
+
 # %flag
 # % key: c
 # % description: GetCapabilities of WCS
@@ -102,17 +119,31 @@
 # % description: List CoverageIds of DescribeCoverage
 # %end
 
+# %flag
+# % key: t
+# % label: Force tiling
+# % description: Do not try to download the whole region with one GetCoverage request first
+# %end
+
+# %flag
+# % key: w
+# % label: Process the tiles in worker processes with temporary mapsets
+# % description: The tiles are downloaded and imported by a pool of nprocs processes, each in its own temporary mapset, instead of downloading all tiles with a thread pool
+# %end
+
 # %rules
 # % exclusive: output,-c,-d,-l
 # % required: output,-c,-d,-l
 # % collective: username,password
 # % requires: coverageid,-d,output,-l
+# % exclusive: -a,-w
 # %end
 
 import atexit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 import os
 import sys
-import xmltodict
 
 from grass.script import core as grass
 from grass.pygrass.utils import get_lib_path
@@ -122,10 +153,6 @@ try:
     from grass_gis_helpers.general import set_nprocs
     from grass_gis_helpers.cleanup import rm_vects
     from grass_gis_helpers.tiling import create_grid
-    from grass_gis_helpers.parallel import (
-        patching_raster_results,
-        run_module_parallel,
-    )
 except ImportError:
     grass.fatal(
         _(
@@ -134,61 +161,405 @@ except ImportError:
         )
     )
 
+# version of r_in_wcs_lib which is required
+LIB_VERSION = "1.0.0"
+
 # initialize global vars
 LOCATION_PATH = None
 MAPSET_NAMES = []
 NPROCS = None
+RM_DIRS = []
+RM_FILES = []
+RM_RASTERS = []
 RM_VECTORS = []
+SESSION = None
 
 
 def cleanup():
     """Cleanup function"""
+    if RM_RASTERS:
+        # one g.remove for all rasters; not existing ones are only warned
+        # about, which is hidden
+        with open(os.devnull, "w", encoding="utf-8") as nuldev:
+            grass.run_command(
+                "g.remove",
+                type="raster",
+                name=",".join(RM_RASTERS),
+                flags="f",
+                quiet=True,
+                stderr=nuldev,
+                errors="ignore",
+            )
     rm_vects(RM_VECTORS)
+    for rm_file in RM_FILES:
+        grass.try_remove(rm_file)
+    for rm_dir in RM_DIRS:
+        try_rmdir(rm_dir)
     # Delete temp_mapsets
     for new_mapset in MAPSET_NAMES:
         try_rmdir(os.path.join(LOCATION_PATH, new_mapset))
 
 
+def shutdown_on_error(*executors):
+    """Shut the executors down without waiting after a tile failed; the
+    queued downloads and imports are cancelled, so that the module does not
+    wait for them, including their retries, before it exits"""
+    for executor in executors:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def check_compression(auth, compression, bbox=None, **kwargs):
+    """Check with a probe request of the region, or of bbox if it is given,
+    whether the server accepts the compression; returns the compression or
+    None if the tifs have to be requested uncompressed, and the status of
+    the probe of the url which is used"""
+    # pylint: disable=import-outside-toplevel,no-name-in-module
+    from r_in_wcs_lib import create_session, probe_url, set_url
+
+    session = create_session()
+
+    def probe(compression):
+        url = set_url(
+            kwargs["url"],
+            kwargs["coverageid"],
+            out=kwargs["output"],
+            axis=kwargs["subset_type"],
+            bbox=bbox,
+            compression=compression,
+        )[0]
+        return probe_url(session, url, auth)
+
+    if compression == "none":
+        return None, probe(None)
+    status = probe(compression)
+    # 413 means the region is too large, not that the compression is
+    # rejected; the compression is only blamed if the uncompressed request
+    # is accepted, servers may also reject the probe itself (e.g. with 405)
+    if status is None or not 400 <= status < 500 or status == 413:
+        return compression, status
+    uncompressed_status = probe(None)
+    if uncompressed_status not in (200, 206):
+        return compression, status
+    grass.warning(
+        _(
+            f"Server rejected the compression {compression} with "
+            f"{status}, requesting uncompressed tifs."
+        )
+    )
+    return None, uncompressed_status
+
+
+def import_region(auth, status, **kwargs):
+    """Try to download the whole region with one GetCoverage request and
+    import it; status is the answer to the probe of the request. Returns
+    False if the server does not deliver it, so that the region has to be
+    tiled"""
+    # pylint: disable=import-outside-toplevel,no-name-in-module
+    from r_in_wcs_lib import (
+        create_session,
+        download_file,
+        get_tif_error,
+        import_vsicurl,
+        set_url,
+    )
+    from requests.exceptions import RequestException
+
+    url = set_url(
+        kwargs["url"],
+        kwargs["coverageid"],
+        out=kwargs["output"],
+        axis=kwargs["subset_type"],
+        compression=kwargs["compression"],
+    )[0]
+    if status not in (200, 206):
+        grass.verbose(
+            _(f"Server answered the probe with {status}, using tiles.")
+        )
+        return False
+
+    # servers which answer range requests are read by GDAL directly
+    if status == 206:
+        grass.message(_("Importing data of the whole region via GDAL..."))
+        if import_vsicurl(url, kwargs["output"], auth):
+            return True
+        grass.verbose(_("Import via GDAL failed, downloading the data."))
+
+    grass.message(_("Retrieving data of the whole region..."))
+    session = create_session()
+    tmp_dir = grass.tempdir()
+    RM_DIRS.append(tmp_dir)
+    tif = os.path.join(tmp_dir, "region.tif")
+    try:
+        download_file(session, url, tif, auth)
+    except RequestException as e:
+        grass.verbose(_(f"Download of the whole region failed: {e}"))
+        return False
+    if get_tif_error(tif) is not None:
+        grass.verbose(_("Broken tif downloaded for the whole region."))
+        return False
+    grass.run_command("r.import", input=tif, output=kwargs["output"])
+    return True
+
+
+def import_tiles(
+    tiles_list, tmp_id, auth, use_async=False, status=None, **kwargs
+):
+    """Download the tiles with a thread pool, or with asyncio if use_async is
+    set, into one temporary directory and import them in parallel into the
+    current mapset; status is the answer to the probe of the first tile, it
+    is probed if not given"""
+    # pylint: disable=import-outside-toplevel,no-name-in-module
+    from r_in_wcs_lib import (
+        create_session,
+        fetch_tifs_async,
+        get_tile_bboxes,
+        import_vsicurl,
+        probe_url,
+        retrieve_tif,
+        set_url,
+    )
+
+    output = kwargs["output"]
+    tmp_dir = grass.tempdir()
+    RM_DIRS.append(tmp_dir)
+
+    tiles = []
+    bboxes = get_tile_bboxes(tiles_list, kwargs["subset_type"])
+    for num, (tile, bbox) in enumerate(zip(tiles_list, bboxes)):
+        url = set_url(
+            kwargs["url"],
+            kwargs["coverageid"],
+            out=output,
+            axis=kwargs["subset_type"],
+            bbox=bbox,
+            compression=kwargs["compression"],
+        )[0]
+        tif = os.path.join(tmp_dir, f"{tile}.tif")
+        tiles.append((f"{output}_tile_{num}_{tmp_id}", url, tif))
+
+    # servers which answer range requests are read by GDAL directly; the
+    # tiles which fail are downloaded
+    if status is None:
+        status = probe_url(create_session(), tiles[0][1], auth)
+    if status == 206:
+        grass.message(_("Importing data via GDAL..."))
+        with ThreadPoolExecutor(max_workers=NPROCS) as executor:
+            streamed = list(
+                executor.map(
+                    lambda tile: import_vsicurl(tile[1], tile[0], auth), tiles
+                )
+            )
+        RM_RASTERS.extend(
+            tile[0] for tile, success in zip(tiles, streamed) if success
+        )
+        download_tiles = [
+            tile for tile, success in zip(tiles, streamed) if not success
+        ]
+    else:
+        download_tiles = tiles
+
+    num_retry = int(kwargs["num_retry"])
+    if download_tiles and use_async:
+        grass.message(_("Retrieving data asynchronously..."))
+        fetch_tifs_async(
+            [(url, tif) for _tile_rast, url, tif in download_tiles],
+            auth,
+            limit=NPROCS * 8,
+            num_retry_max=num_retry,
+        )
+        grass.message(_("Importing data..."))
+        executor = ThreadPoolExecutor(max_workers=NPROCS)
+        try:
+            imports = []
+            for tile_rast, _url, tif in download_tiles:
+                RM_RASTERS.append(tile_rast)
+                imports.append(
+                    executor.submit(
+                        grass.run_command,
+                        "r.import",
+                        input=tif,
+                        output=tile_rast,
+                        quiet=True,
+                    )
+                )
+            for future in as_completed(imports):
+                future.result()
+        except BaseException:
+            shutdown_on_error(executor)
+            raise
+        executor.shutdown()
+    elif download_tiles:
+        grass.message(_("Retrieving and importing data..."))
+        num_threads = NPROCS * 4
+        session = create_session(num_threads, http2=True)
+        # each tile is imported as soon as it is downloaded and validated,
+        # so the imports overlap with the remaining downloads; r.import runs
+        # as subprocess, so the import threads only wait for it
+        download_executor = ThreadPoolExecutor(max_workers=num_threads)
+        import_executor = ThreadPoolExecutor(max_workers=NPROCS)
+        try:
+            downloads = {
+                download_executor.submit(
+                    retrieve_tif, session, url, tif, auth, num_retry
+                ): (tile_rast, tif)
+                for tile_rast, url, tif in download_tiles
+            }
+            imports = []
+            for download in as_completed(downloads):
+                download.result()
+                tile_rast, tif = downloads[download]
+                RM_RASTERS.append(tile_rast)
+                imports.append(
+                    import_executor.submit(
+                        grass.run_command,
+                        "r.import",
+                        input=tif,
+                        output=tile_rast,
+                        quiet=True,
+                    )
+                )
+            for future in as_completed(imports):
+                future.result()
+        except BaseException:
+            shutdown_on_error(download_executor, import_executor)
+            raise
+        download_executor.shutdown()
+        import_executor.shutdown()
+        session.close()
+
+    tile_rasts = [tile_rast for tile_rast, _url, _tif in tiles]
+    grass.message(_(f"Patching raster {output} subsets ..."))
+    if len(tile_rasts) > 1:
+        grass.run_command(
+            "r.patch", input=tile_rasts, output=output, quiet=True
+        )
+    else:
+        grass.run_command("g.copy", raster=f"{tile_rasts[0]},{output}")
+
+
+def import_tile(tile, auth, tmp_dir, **kwargs):
+    """Download and import one tile into the mapset of the pool process;
+    returns the name of the imported raster map"""
+    global SESSION
+
+    # pylint: disable=import-outside-toplevel,no-name-in-module
+    from r_in_wcs_lib import (
+        create_session,
+        get_tile_bboxes,
+        retrieve_tif,
+        set_url,
+    )
+
+    # one session per pool process, so that the connection is reused
+    if SESSION is None:
+        SESSION = create_session()
+    tile_name = tile.split("@")[0]
+    tile_rast = f"{kwargs['output']}_{tile_name}"
+    url = set_url(
+        kwargs["url"],
+        kwargs["coverageid"],
+        out=kwargs["output"],
+        axis=kwargs["subset_type"],
+        bbox=get_tile_bboxes([tile], kwargs["subset_type"])[0],
+        compression=kwargs["compression"],
+    )[0]
+    tif = os.path.join(tmp_dir, f"{tile_name}.tif")
+    retrieve_tif(SESSION, url, tif, auth, int(kwargs["num_retry"]))
+    grass.run_command("r.import", input=tif, output=tile_rast, quiet=True)
+    return tile_rast
+
+
+def import_tiles_mapsets(tiles_list, tmp_id, auth, **kwargs):
+    """Download and import the tiles in a process pool, where each process
+    works in its own temporary mapset, and patch the results"""
+    global MAPSET_NAMES, LOCATION_PATH
+
+    # pylint: disable=import-outside-toplevel,no-name-in-module
+    from r_in_wcs_parallel import run_tiles
+
+    env = grass.gisenv()
+    LOCATION_PATH = os.path.join(env["GISDBASE"], env["LOCATION_NAME"])
+    tmp_dir = grass.tempdir()
+    RM_DIRS.append(tmp_dir)
+    tiles = [f"{tile}@{env['MAPSET']}" for tile in tiles_list]
+    try:
+        results = run_tiles(
+            partial(import_tile, auth=auth, tmp_dir=tmp_dir, **kwargs),
+            tiles,
+            NPROCS,
+            tmp_id,
+        )
+    finally:
+        # the mapsets of the pool processes are named by the pid
+        MAPSET_NAMES = [
+            mapset
+            for mapset in os.listdir(LOCATION_PATH)
+            if mapset.startswith(f"tmp_r_in_wcs_{tmp_id}_")
+        ]
+        # switch_to_new_mapset creates a GISRC copy named by the pid
+        RM_FILES.extend(
+            f"{os.environ['GISRC']}_{mapset.rsplit('_', 1)[1]}"
+            for mapset in MAPSET_NAMES
+        )
+    tile_rasts = [f"{rast}@{mapset}" for mapset, rast in results]
+    grass.message(_(f"Patching raster {kwargs['output']} subsets ..."))
+    if len(tile_rasts) > 1:
+        grass.run_command(
+            "r.patch", input=tile_rasts, output=kwargs["output"], quiet=True
+        )
+    else:
+        grass.run_command(
+            "g.copy", raster=f"{tile_rasts[0]},{kwargs['output']}"
+        )
+
+
 def main():
     """Main function of r.in.wcs"""
-    global MAPSET_NAMES, LOCATION_PATH, NPROCS, RM_VECTORS
+    global NPROCS, RM_VECTORS
 
     path = get_lib_path(modname="r.in.wcs", libname="r_in_wcs_lib")
     if path is None:
         grass.fatal("Unable to find the r.in.wcs library directory.")
-    sys.path.append(path)
+    if path not in sys.path:
+        sys.path.append(path)
     try:
         # pylint: disable=import-outside-toplevel,no-name-in-module
         from r_in_wcs_lib import (
+            __version__ as lib_version,
+            fetch_xml_bytes,
+            get_axis_label,
+            get_coverage_ids,
+            get_credentials,
+            get_tile_bboxes,
+            pretty_xml,
             set_url,
-            get_xml_data,
         )
     except ImportError:
-        grass.fatal("analyse_trees_lib missing.")
+        grass.fatal("r_in_wcs_lib missing or outdated.")
+    if lib_version != LIB_VERSION:
+        grass.fatal(
+            _(
+                f"r_in_wcs_lib version {lib_version} found in {path}, but "
+                f"version {LIB_VERSION} is required. Please reinstall r.in.wcs."
+            )
+        )
 
     wcs_url = options["url"]
     coverageid = options["coverageid"]
     NPROCS = set_nprocs(options["nprocs"])
 
+    auth = get_credentials(options["username"], options["password"])
+
     url, msg = set_url(wcs_url, coverageid)
-    pretty_xml = get_xml_data(url, options["username"], options["password"])
     if flags["c"] or flags["d"]:
-        print(f"{msg}:\n{pretty_xml}")
+        xml_bytes = fetch_xml_bytes(url, auth)
+        print(f"{msg}:\n{pretty_xml(xml_bytes)}")
     elif flags["l"]:
-        parsedresp = xmltodict.parse(pretty_xml)
-        coverage_ids = [
-            cov["wcs:CoverageId"]
-            for cov in parsedresp["wcs:Capabilities"]["wcs:Contents"][
-                "wcs:CoverageSummary"
-            ]
-        ]
+        coverage_ids = get_coverage_ids(fetch_xml_bytes(url, auth))
         print("\n".join(coverage_ids))
     elif options["output"]:
         # get subset type: NE or LatLong
-        parsedresp = xmltodict.parse(pretty_xml)
-        axis_label = parsedresp["wcs:CoverageDescriptions"][
-            "wcs:CoverageDescription"
-        ]["gml:boundedBy"]["gml:Envelope"]["@axisLabels"]
+        axis_label = get_axis_label(url, auth)
 
         module_kwargs = {
             "url": wcs_url,
@@ -199,23 +570,42 @@ def main():
             "password": options["password"],
             "num_retry": options["num_retry"],
         }
+        if not flags["t"]:
+            module_kwargs["compression"], status = check_compression(
+                auth, options["compression"], **module_kwargs
+            )
+            if import_region(auth, status, **module_kwargs):
+                grass.message(
+                    _(f"Ouput raster map {options['output']} created.")
+                )
+                return 0
+
         # create tiles
         tmp_id = grass.tempname(12)
         tiles_list = create_grid(options["tile_size"], "wcs_grid", tmp_id)
         RM_VECTORS.extend(tiles_list)
+        status = None
+        if flags["t"]:
+            # the whole region can be too large for one request, so only the
+            # first tile is probed
+            module_kwargs["compression"], status = check_compression(
+                auth,
+                options["compression"],
+                bbox=get_tile_bboxes(tiles_list[:1], axis_label)[0],
+                **module_kwargs,
+            )
 
-        # run worker module parallel
-        MAPSET_NAMES, LOCATION_PATH = run_module_parallel(
-            "r.in.wcs.worker",
-            module_kwargs,
-            tiles_list,
-            NPROCS,
-            tmp_id,
-            # parallel=False,
-        )
-        if len(MAPSET_NAMES) != len(tiles_list):
-            return 1
-        patching_raster_results(MAPSET_NAMES, options["output"])
+        if flags["w"]:
+            import_tiles_mapsets(tiles_list, tmp_id, auth, **module_kwargs)
+        else:
+            import_tiles(
+                tiles_list,
+                tmp_id,
+                auth,
+                use_async=flags["a"],
+                status=status,
+                **module_kwargs,
+            )
         grass.message(_(f"Ouput raster map {options['output']} created."))
 
 
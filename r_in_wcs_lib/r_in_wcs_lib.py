@@ -2,10 +2,10 @@
 #
 ############################################################################
 #
-# MODULE:      Library for r.in.wcs and r.in.wcs.worker
+# MODULE:      Library for r.in.wcs
 # AUTHOR(S):   Anika Weinmann
 #
-# PURPOSE:     Library for r.in.wcs and r.in.wcs.worker
+# PURPOSE:     Library for r.in.wcs
 # COPYRIGHT:   (C) 2023 by Anika Weinmann, mundialis GmbH & Co. KG and the
 #              GRASS Development Team
 #
@@ -21,23 +21,153 @@
 #
 #############################################################################
 
+import asyncio
+from functools import lru_cache
+import hashlib
+from io import BytesIO
 import os
+import random
+import time
 
-from urllib.request import urlopen
-from urllib.request import build_opener, install_opener
-from urllib.request import (
-    HTTPPasswordMgrWithDefaultRealm,
-    HTTPBasicAuthHandler,
-)
-from urllib.error import URLError, HTTPError
+import requests
+from requests.adapters import HTTPAdapter
 
-from bs4 import BeautifulSoup
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from lxml import etree
 
 import grass.script as grass
+from grass.pygrass.vector import VectorTopo
+from grass_gis_helpers.validation import get_gdalinfo_returncodes
+
+# version of the library, checked by r.in.wcs to detect a stale installation
+# of the library
+__version__ = "1.0.0"
+
+GML_NS = "http://www.opengis.net/gml/3.2"
+WCS_NS = "http://www.opengis.net/wcs/2.0"
+if httpx is None:
+    DOWNLOAD_ERRORS = (requests.exceptions.RequestException,)
+else:
+    DOWNLOAD_ERRORS = (requests.exceptions.RequestException, httpx.HTTPError)
+# seconds after which xml data cached in GRASS_WCS_CACHE_DIR is requested
+# again, if GRASS_WCS_CACHE_EXPIRE does not set them
+CACHE_EXPIRE = 3600
+
+
+def get_bbox(axis):
+    """Function to get the bounding box (north, south, east, west) of the
+    current region for the subset axis of the coverage"""
+    if axis == "E N":
+        reg = grass.region()
+        return (
+            float(reg["n"]),
+            float(reg["s"]),
+            float(reg["e"]),
+            float(reg["w"]),
+        )
+    if axis == "Lat Long":
+        reg = grass.parse_command("g.region", flags="bg", quiet=True)
+        return (
+            float(reg["ll_n"]),
+            float(reg["ll_s"]),
+            float(reg["ll_e"]),
+            float(reg["ll_w"]),
+        )
+    grass.fatal(_("Subset not yet supported."))
+    return None
+
+
+def _to_latlong(bboxes):
+    """Function to transform bounding boxes (north, south, east, west) of
+    the current location to lat/long with one m.proj call"""
+    if grass.locn_is_latlong():
+        return bboxes
+    coords = "\n".join(
+        f"{x} {y}"
+        for north, south, east, west in bboxes
+        for x, y in (
+            (west, north),
+            (east, north),
+            (east, south),
+            (west, south),
+        )
+    )
+    proc = grass.start_command(
+        "m.proj",
+        flags="od",
+        input="-",
+        separator="space",
+        stdin=grass.PIPE,
+        stdout=grass.PIPE,
+        quiet=True,
+    )
+    out = proc.communicate(coords.encode())[0].decode()
+    if proc.returncode != 0:
+        grass.fatal(_("Failed to transform the tiles to lat/long."))
+    lon_lat = [
+        [float(val) for val in line.split()[:2]] for line in out.splitlines()
+    ]
+    ll_bboxes = []
+    # four corners per bounding box
+    for corners in zip(*[iter(lon_lat)] * 4):
+        lons = [lon for lon, _lat in corners]
+        lats = [lat for _lon, lat in corners]
+        ll_bboxes.append((max(lats), min(lats), max(lons), min(lons)))
+    return ll_bboxes
+
 
+def get_tile_bboxes(tiles, axis):
+    """Function to get the bounding boxes (north, south, east, west) of the
+    tile vector maps for the subset axis of the coverage; the vector maps
+    are read with pygrass, so no g.region call is needed per tile"""
+    bboxes = []
+    for tile in tiles:
+        name, _sep, mapset = tile.partition("@")
+        vect = VectorTopo(name, mapset=mapset)
+        vect.open("r")
+        bbox = vect.bbox()
+        vect.close()
+        bboxes.append((bbox.north, bbox.south, bbox.east, bbox.west))
+    if axis == "E N":
+        return bboxes
+    if axis == "Lat Long":
+        return _to_latlong(bboxes)
+    grass.fatal(_("Subset not yet supported."))
+    return None
 
-def set_url(wcs_url, coverageid=None, out=None, version="2.0.1", axis="N E"):
-    """Function to set the url for service"""
+
+@lru_cache(maxsize=None)
+def _get_coverage_prefix(wcs_url, coverageid, version, compression=None):
+    """Function to get the static part of the GetCoverage url"""
+    prefix = (
+        f"{wcs_url}service=WCS&version={version}&request=GetCoverage&"
+        f"CoverageId={coverageid}&format=image/tiff"
+    )
+    # GeoTIFF coverage encoding extension of WCS 2.0
+    if compression:
+        prefix += f"&geotiff:compression={compression}"
+    # the predictor is only defined for LZW and Deflate
+    if compression in ("LZW", "Deflate"):
+        prefix += "&geotiff:predictor=Horizontal"
+    return prefix
+
+
+def set_url(
+    wcs_url,
+    coverageid=None,
+    out=None,
+    version="2.0.1",
+    axis="N E",
+    bbox=None,
+    compression=None,
+):
+    """Function to set the url for service; for GetCoverage the subset is
+    taken from bbox (north, south, east, west) or from the current region
+    and the tif is requested with the compression, if it is set"""
     # WCS - GetCapabilities
     if coverageid is None or coverageid == "":
         url = f"{wcs_url}service=WCS&version={version}&request=GetCapabilities"
@@ -52,18 +182,16 @@ def set_url(wcs_url, coverageid=None, out=None, version="2.0.1", axis="N E"):
         grass.debug(url)
         msg = f"DescribeCoverage of {url}"
     else:
+        if bbox is None:
+            bbox = get_bbox(axis)
+        reg_ns = bbox[:2]
+        reg_ew = bbox[2:]
         if axis == "E N":
-            reg = grass.region()
-            reg_ns = [float(reg["n"]), float(reg["s"])]
-            reg_ew = [float(reg["e"]), float(reg["w"])]
             subset = (
                 f"&subset=N({min(reg_ns)},{max(reg_ns)})"
                 f"&subset=E({min(reg_ew)},{max(reg_ew)})"
             )
         elif axis == "Lat Long":
-            reg = grass.parse_command("g.region", flags="bg", quiet=True)
-            reg_ns = [float(reg["ll_n"]), float(reg["ll_s"])]
-            reg_ew = [float(reg["ll_e"]), float(reg["ll_w"])]
             subset = (
                 f"&subset=Lat({min(reg_ns)},{max(reg_ns)})"
                 f"&subset=Long({min(reg_ew)},{max(reg_ew)})"
@@ -72,61 +200,397 @@ def set_url(wcs_url, coverageid=None, out=None, version="2.0.1", axis="N E"):
             grass.fatal(_("Subset not yet supported."))
 
         url = (
-            f"{wcs_url}service=WCS&version={version}&request=GetCoverage&"
-            f"CoverageId={coverageid}&format=image/tiff{subset}"
+            _get_coverage_prefix(wcs_url, coverageid, version, compression)
+            + subset
         )
         grass.debug(url)
         msg = None
     return url, msg
 
 
-def set_user_pw(url, user_inp, password_inp):
+def create_session(pool_size=1, http2=False):
+    """Function to create a session which reuses its connections; with
+    http2 a httpx client is used if httpx and h2 are installed, so that the
+    requests are multiplexed over one connection, otherwise a requests
+    session"""
+    if http2 and httpx is not None:
+        limits = httpx.Limits(
+            max_connections=pool_size, max_keepalive_connections=pool_size
+        )
+        try:
+            # follow redirects like the requests session does
+            return httpx.Client(
+                http2=True, limits=limits, follow_redirects=True
+            )
+        except ImportError:
+            grass.verbose(_("h2 is not installed, HTTP/2 is not used."))
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _write_response(chunks, out_file):
+    """Function to write the chunks of a response into a file"""
+    with open(out_file, "wb") as out_f:
+        for chunk in chunks:
+            out_f.write(chunk)
+
+
+def download_file(session, url, out_file, auth=None):
+    """Function to stream the response of the url into a file"""
+    if httpx is not None and isinstance(session, httpx.Client):
+        timeout = httpx.Timeout(60, connect=5)
+        with session.stream("GET", url, auth=auth, timeout=timeout) as resp:
+            resp.raise_for_status()
+            _write_response(resp.iter_bytes(1 << 20), out_file)
+        return
+    with session.get(url, stream=True, auth=auth, timeout=(5, 60)) as resp:
+        resp.raise_for_status()
+        # iter_content wraps the urllib3 errors of a truncated or stalled
+        # body into requests exceptions, so that they are retried
+        _write_response(resp.iter_content(1 << 20), out_file)
+
+
+def _backoff(attempt, base=0.5, cap=30.0):
+    """Capped exponential backoff with full jitter for the download retries"""
+    return random.uniform(0, min(cap, base * (2**attempt)))
+
+
+def probe_url(session, url, auth=None):
+    """Function to probe with a HEAD request whether the server would
+    deliver the url; the session can be a requests session or a httpx
+    client; returns the HTTP status code or None if the server is not
+    reachable"""
+    headers = {"Range": "bytes=0-0"}
+    try:
+        if httpx is not None and isinstance(session, httpx.Client):
+            resp = session.head(
+                url,
+                auth=auth,
+                headers=headers,
+                timeout=httpx.Timeout(60, connect=5),
+            )
+        else:
+            # requests does not follow redirects for HEAD by default
+            resp = session.head(
+                url,
+                auth=auth,
+                headers=headers,
+                timeout=(5, 60),
+                allow_redirects=True,
+            )
+    except DOWNLOAD_ERRORS:
+        return None
+    resp.close()
+    return resp.status_code
+
+
+def _quick_validate(tif):
+    """Function to check a downloaded tif in-process with the GDAL python
+    bindings; reads the first and the last block of the first band and
+    returns the error message and a return code like
+    get_gdalinfo_returncodes, or None if the check is not possible"""
+    # imported here, so that runs which do not download tifs do not pay for
+    # loading GDAL
+    try:
+        # pylint: disable=import-outside-toplevel
+        from osgeo import gdal
+    except ImportError:
+        return None
+    gdal.ErrorReset()
+    gdal.PushErrorHandler("CPLQuietErrorHandler")
+    try:
+        dataset = gdal.Open(tif)
+        if dataset is None:
+            return gdal.GetLastErrorMsg(), 1
+        if dataset.GetDriver().ShortName != "GTiff":
+            # unknown driver, leave the check to gdalinfo
+            return None
+        if dataset.RasterXSize == 0 or dataset.RasterYSize == 0:
+            return "Empty raster", 1
+        band = dataset.GetRasterBand(1)
+        block_x, block_y = band.GetBlockSize()
+        last_x = (dataset.RasterXSize - 1) // block_x
+        last_y = (dataset.RasterYSize - 1) // block_y
+        for xoff, yoff in ((0, 0), (last_x, last_y)):
+            if band.ReadBlock(xoff, yoff) is None:
+                return gdal.GetLastErrorMsg(), 1
+    except RuntimeError as error:
+        # raised instead of returning None if gdal exceptions are enabled
+        return str(error), 1
+    finally:
+        gdal.PopErrorHandler()
+    return gdal.GetLastErrorMsg(), 0
+
+
+def get_tif_error(tif):
+    """Function to check a downloaded tif in-process or with gdalinfo as
+    fallback; returns the error message if the tif is broken and None
+    otherwise"""
+    result = _quick_validate(tif)
+    if result is None:
+        result = get_gdalinfo_returncodes(tif)
+    gdalinfo_err, gdalinfo_returncode = result
+    if (
+        gdalinfo_returncode != 0
+        or ("TIFFReadEncodedStrip" in gdalinfo_err)
+        or ("TIFFReadEncodedTile" in gdalinfo_err)
+    ):
+        return gdalinfo_err
+    return None
+
+
+def _connection_failed(url, error, attempt, num_retry_max):
+    """Function to handle a failed download attempt; fails after the last
+    attempt and returns the seconds to wait before the next one otherwise"""
+    if attempt == num_retry_max:
+        grass.fatal(
+            _(
+                f"Failed to reach the server.\nURL: {url} "
+                f"after {num_retry_max} retries."
+            )
+        )
+    grass.warning(
+        _(
+            f"Failed to reach the server.\nURL: {url}. With Error {error}. "
+            f"Retry {attempt + 1}/{num_retry_max} ..."
+        )
+    )
+    return _backoff(attempt)
+
+
+def _broken_tif(gdalinfo_err, attempt, num_retry_max):
+    """Function to handle a broken downloaded tif; fails after the last
+    attempt and returns the seconds to wait before the next one otherwise"""
+    if attempt == num_retry_max:
+        grass.fatal(
+            _(f"Failed to download tif after {num_retry_max} retries.")
+        )
+    grass.warning(
+        _(
+            f"Broken tif downloaded, with error {gdalinfo_err}."
+            " Try to re-download. Retry "
+            f"{attempt + 1}/{num_retry_max} ..."
+        )
+    )
+    return _backoff(attempt)
+
+
+def retrieve_tif(session, url, tif, auth=None, num_retry_max=0):
+    """Function to download a tif and re-download it if the server is not
+    reachable or the downloaded tif is broken; the tif is downloaded to
+    <tif>.new and only moved to tif if it is valid"""
+    tmp_tif = f"{tif}.new"
+    for attempt in range(num_retry_max + 1):
+        try:
+            download_file(session, url, tmp_tif, auth)
+        except DOWNLOAD_ERRORS as e:
+            time.sleep(_connection_failed(url, e, attempt, num_retry_max))
+            continue
+        gdalinfo_err = get_tif_error(tmp_tif)
+        if gdalinfo_err is None:
+            os.replace(tmp_tif, tif)
+            break
+        time.sleep(_broken_tif(gdalinfo_err, attempt, num_retry_max))
+
+
+async def _fetch_tif(session, url, tif, num_retry_max):
+    """Coroutine to download a tif with aiohttp and re-download it if the
+    server is not reachable or the downloaded tif is broken"""
+    # pylint: disable=import-outside-toplevel
+    import aiofiles
+    import aiohttp
+
+    tmp_tif = f"{tif}.new"
+    loop = asyncio.get_running_loop()
+    for attempt in range(num_retry_max + 1):
+        try:
+            async with session.get(url) as resp:
+                resp.raise_for_status()
+                async with aiofiles.open(tmp_tif, "wb") as out_f:
+                    async for chunk in resp.content.iter_chunked(1 << 20):
+                        await out_f.write(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            await asyncio.sleep(
+                _connection_failed(url, e, attempt, num_retry_max)
+            )
+            continue
+        # the tif check blocks, so it is waited for in a thread
+        gdalinfo_err = await loop.run_in_executor(None, get_tif_error, tmp_tif)
+        if gdalinfo_err is None:
+            os.replace(tmp_tif, tif)
+            break
+        await asyncio.sleep(_broken_tif(gdalinfo_err, attempt, num_retry_max))
+
+
+def fetch_tifs_async(urls_tifs, auth=None, limit=8, num_retry_max=0):
+    """Function to download the tifs concurrently with asyncio and aiohttp
+    in one thread; urls_tifs is a list of (url, tif) tuples"""
+    # imported here, so that only the -a runs pay for loading them
+    try:
+        # pylint: disable=import-outside-toplevel,unused-import
+        import aiofiles  # noqa: F401
+        import aiohttp
+    except ImportError:
+        grass.fatal(
+            _(
+                "Please install the python libraries aiohttp and aiofiles "
+                "for the async download: <pip install aiohttp aiofiles>"
+            )
+        )
+
+    async def _fetch_all():
+        connector = aiohttp.TCPConnector(limit=limit)
+        timeout = aiohttp.ClientTimeout(sock_connect=5, sock_read=60)
+        basic_auth = aiohttp.BasicAuth(*auth) if auth else None
+        async with aiohttp.ClientSession(
+            auth=basic_auth, connector=connector, timeout=timeout
+        ) as session:
+            await asyncio.gather(
+                *[
+                    _fetch_tif(session, url, tif, num_retry_max)
+                    for url, tif in urls_tifs
+                ]
+            )
+
+    asyncio.run(_fetch_all())
+
+
+def import_vsicurl(url, output, auth=None):
+    """Function to import the url with r.import directly via GDAL /vsicurl/
+    without downloading it first; the server has to support range requests;
+    returns True if the import succeeded"""
+    env = os.environ.copy()
+    env["GDAL_DISABLE_READDIR_ON_OPEN"] = "EMPTY_DIR"
+    if auth is not None:
+        env["GDAL_HTTP_AUTH"] = "BASIC"
+        env["GDAL_HTTP_USERPWD"] = f"{auth[0]}:{auth[1]}"
+    returncode = grass.run_command(
+        "r.import",
+        input=f"/vsicurl/{url}",
+        output=output,
+        env=env,
+        quiet=True,
+        errors="status",
+    )
+    return returncode == 0
+
+
+def _resolve(inp):
+    """Function to resolve an option which can be a file, an environment
+    variable name or the value itself"""
+    if os.path.isfile(inp):
+        with open(inp, encoding="UTF-8") as inp_f:
+            return inp_f.read().strip()
+    if inp in os.environ:
+        return os.environ[inp]
+    return inp
+
+
+def get_credentials(user_inp, password_inp):
     """Function to get the username and password from option, file or
-    environment variable"""
+    environment variable; returns the auth tuple for requests or None"""
     if user_inp and password_inp:
         grass.message(_("Setting username and password..."))
-        if os.path.isfile(user_inp):
-            with open(user_inp, encoding="UTF-8") as user_f:
-                filecontent = user_f.read()
-                user = filecontent.strip()
-        elif user_inp in os.environ:
-            user = os.environ[user_inp]
-        else:
-            user = user_inp
-
-        if os.path.isfile(password_inp):
-            with open(password_inp, encoding="UTF-8") as pw_f:
-                filecontent = pw_f.read()
-                password = filecontent.strip()
-        elif password_inp in os.environ:
-            password = os.environ[password_inp]
-        else:
-            password = password_inp
-
-        passmgr = HTTPPasswordMgrWithDefaultRealm()
-        passmgr.add_password(None, url, user, password)
-        authhandler = HTTPBasicAuthHandler(passmgr)
-        opener = build_opener(authhandler)
-        install_opener(opener)
-        grass.message(_("Setting username and password finished"))
+        return (_resolve(user_inp), _resolve(password_inp))
+    return None
 
 
-def get_xml_data(url, user, password):
-    """Function to get the xml data from url"""
-    set_user_pw(url, user, password)
-    out = ""
+def _request_xml(url, auth=None):
+    """Function to request the xml data from url; the response is streamed,
+    so it has to be closed by the caller"""
     try:
-        with urlopen(url) as inf:
-            out += inf.read().decode()
-    except HTTPError as http_e:
+        resp = requests.get(url, auth=auth, stream=True, timeout=(5, 60))
+        resp.raise_for_status()
+    except requests.exceptions.HTTPError as http_e:
         # GTC WFS request HTTP failure
         grass.fatal(
             _(
                 "The server couldn't fulfill the request.\n"
-                f"Error code: {http_e.code}"
+                f"Error code: {http_e.response.status_code}"
             )
         )
-    except URLError as url_e:
-        grass.fatal(_(f"Failed to reach the server.\nReason: {url_e.reason}"))
-    xml_out = BeautifulSoup(out, "xml")
-    return xml_out.prettify()
+    except requests.exceptions.RequestException as url_e:
+        grass.fatal(_(f"Failed to reach the server.\nReason: {url_e}"))
+    resp.raw.decode_content = True
+    return resp
+
+
+def _get_cache_file(url, auth=None):
+    """Function to get the file the xml data of url is cached in, if the
+    cache directory is set by GRASS_WCS_CACHE_DIR, and None otherwise; the
+    username is part of the key, so responses are not shared between users"""
+    cache_dir = os.environ.get("GRASS_WCS_CACHE_DIR")
+    if not cache_dir:
+        return None
+    user = auth[0] if auth else ""
+    key_hash = hashlib.sha1(f"{user}\0{url}".encode()).hexdigest()
+    return os.path.join(cache_dir, f"{key_hash}.xml")
+
+
+def fetch_xml_bytes(url, auth=None):
+    """Function to get the raw xml data from url; the data is read from and
+    written to the cache directory GRASS_WCS_CACHE_DIR if it is set and
+    requested again after GRASS_WCS_CACHE_EXPIRE seconds, CACHE_EXPIRE by
+    default; with 0 or less the cached data does not expire"""
+    cache_file = _get_cache_file(url, auth)
+    expire = float(os.environ.get("GRASS_WCS_CACHE_EXPIRE", CACHE_EXPIRE))
+    if (
+        cache_file
+        and os.path.isfile(cache_file)
+        and (
+            expire <= 0 or time.time() - os.path.getmtime(cache_file) < expire
+        )
+    ):
+        with open(cache_file, "rb") as xml_file:
+            return xml_file.read()
+    with _request_xml(url, auth) as resp:
+        xml_bytes = resp.content
+    if cache_file:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(f"{cache_file}.new", "wb") as xml_file:
+            xml_file.write(xml_bytes)
+        os.replace(f"{cache_file}.new", cache_file)
+    return xml_bytes
+
+
+def pretty_xml(xml_bytes):
+    """Function to pretty print raw xml data"""
+    parser = etree.XMLParser(remove_blank_text=True)
+    root = etree.fromstring(xml_bytes, parser)
+    return etree.tostring(
+        root, pretty_print=True, xml_declaration=True, encoding="UTF-8"
+    ).decode()
+
+
+def get_coverage_ids(xml_bytes):
+    """Function to get the coverage ids from GetCapabilities xml data"""
+    root = etree.fromstring(xml_bytes)
+    return root.xpath(
+        "//wcs:Contents/wcs:CoverageSummary/wcs:CoverageId/text()",
+        namespaces={"wcs": WCS_NS},
+    )
+
+
+def _parse_axis_label(xml_stream, url):
+    """Function to get the axis labels of the first gml:Envelope in the
+    xml stream"""
+    for _event, elem in etree.iterparse(
+        xml_stream, events=("start",), tag=f"{{{GML_NS}}}Envelope"
+    ):
+        return elem.get("axisLabels")
+    grass.fatal(_(f"No gml:Envelope found in DescribeCoverage of {url}"))
+    return None
+
+
+def get_axis_label(url, auth=None):
+    """Function to get the axis labels of the coverage envelope from the
+    DescribeCoverage xml of url"""
+    if _get_cache_file(url, auth):
+        return _parse_axis_label(BytesIO(fetch_xml_bytes(url, auth)), url)
+    with _request_xml(url, auth) as resp:
+        return _parse_axis_label(resp.raw, url)
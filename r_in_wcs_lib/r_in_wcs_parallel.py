@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+#
+############################################################################
+#
+# MODULE:      Parallel library for r.in.wcs
+# AUTHOR(S):   Anika Weinmann
+#
+# PURPOSE:     Process pool for r.in.wcs which runs each pool process in its
+#              own temporary mapset
+# COPYRIGHT:   (C) 2023 by Anika Weinmann, mundialis GmbH & Co. KG and the
+#              GRASS Development Team
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#############################################################################
+
+from functools import partial
+from multiprocessing import Pool
+import os
+
+import grass.script as grass
+from grass.exceptions import CalledModuleError, ScriptError
+from grass_gis_helpers.mapset import switch_to_new_mapset
+
+# mapset of the pool process
+MAPSET = None
+
+
+class TileError(Exception):
+    """Error of the processing of one tile in a pool process; only carries
+    the message, so that it can be sent to the parent process"""
+
+
+def _init_grass_mapset(uid):
+    """Initializer of the pool processes which switches each process once to
+    its own new mapset"""
+    global MAPSET
+
+    # grass.fatal raises instead of exiting, which would kill the pool
+    # process and let the pool wait forever for the result
+    grass.set_raise_on_error(True)
+    MAPSET = f"tmp_r_in_wcs_{uid}_{os.getpid()}"
+    switch_to_new_mapset(MAPSET)
+
+
+def _run_tile(func, tile):
+    """Run func for one tile in the pool process; returns the mapset of the
+    pool process and the result of func"""
+    try:
+        return MAPSET, func(tile)
+    except (ScriptError, CalledModuleError) as e:
+        raise TileError(f"Processing of tile <{tile}> failed: {e}") from e
+    except SystemExit as e:
+        raise TileError(f"Processing of tile <{tile}> failed.") from e
+
+
+def run_tiles(func, tiles, nprocs, uid):
+    """Run func for each tile in a pool of nprocs processes; each process
+    is initialized once with its own mapset, so the mapset setup is not
+    repeated for each tile
+
+    Args:
+        func (function): function called with one tile
+        tiles (list): list of tiles
+        nprocs (int): number of processes
+        uid (str): unique identifier for the mapset names
+    Returns:
+        (list): list with a tuple (mapset, result of func) for each tile
+    """
+    chunksize = max(1, len(tiles) // (nprocs * 4))
+    with Pool(nprocs, initializer=_init_grass_mapset, initargs=(uid,)) as pool:
+        try:
+            return list(
+                pool.imap_unordered(
+                    partial(_run_tile, func), tiles, chunksize=chunksize
+                )
+            )
+        except TileError as e:
+            grass.fatal(str(e))
+    return None
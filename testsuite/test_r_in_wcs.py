@@ -21,88 +21,111 @@
 #
 #############################################################################
 
+from contextlib import redirect_stdout
+from io import BytesIO, StringIO
+import importlib.util
 import os
+import re
+import shutil
+import sys
+import tempfile
+
+from lxml import etree
 
 from grass.gunittest.case import TestCase
 from grass.gunittest.main import test
 from grass.gunittest.gmodules import SimpleModule
+from grass.pygrass.utils import get_lib_path
 import grass.script as grass
 
 
-class TestRInWcs(TestCase):
-    """Test class for r.in.wcs"""
+class RInWcsTestCase(TestCase):
+    """Base class for the r.in.wcs tests with the WCS settings and a cache
+    for the xml responses of the WCS"""
 
     pid = os.getpid()
-    region = f"r_in_wcs_orig_region_{pid}"
-    out = f"r_in_wcs_test_output_{pid}"
     # WCS and coverageId
     url = "https://geoserver.mundialis.de/geoserver/global/ows?"
     coverageid = "global__worldpop_2020_1km_aggregated_UNadj"
-    num_coverage_ids = 11
-    coverage_name = "Worldpop 2020 1km aggregated UNadj Pop. density"
-    north = 186650
-    south = 185425
-    west = 172622
-    east = 174012
-    num_data = None
+    cache_dir = None
+    cache_expire = None
+    keep_cache = False
 
     @classmethod
     # pylint: disable=invalid-name
     def setUpClass(cls):
-        """Ensures expected computational region"""
-        cls.num_data = len(
-            grass.parse_command("g.list", type="all", mapset=".")
-        )
-        # set region
-        cls.runModule("g.region", save=cls.region)
-        cls.runModule(
-            "g.region",
-            n=cls.north,
-            s=cls.south,
-            w=cls.west,
-            e=cls.east,
-            res=1,
-        )
+        """Caches the xml responses of the WCS for all tests of the class;
+        if GRASS_WCS_CACHE_DIR is already set, the responses recorded there
+        by an earlier run are replayed without expiring and the cache is
+        kept"""
+        cls.cache_dir = os.environ.get("GRASS_WCS_CACHE_DIR")
+        cls.keep_cache = bool(cls.cache_dir)
+        if cls.keep_cache:
+            cls.cache_expire = os.environ.get("GRASS_WCS_CACHE_EXPIRE")
+            os.environ["GRASS_WCS_CACHE_EXPIRE"] = "0"
+        else:
+            cls.cache_dir = tempfile.mkdtemp(prefix="r_in_wcs_cache_")
+            os.environ["GRASS_WCS_CACHE_DIR"] = cls.cache_dir
 
     @classmethod
     # pylint: disable=invalid-name
     def tearDownClass(cls):
-        """Remove the temporary region and generated data"""
-        cls.runModule("g.region", region=cls.region)
-        cls.runModule("g.remove", type="region", name=cls.region, flags="f")
-        # check number of data in mapset
-        num_data = len(grass.parse_command("g.list", type="all", mapset="."))
-        if num_data != cls.num_data:
-            cls.fail(cls, "Test or addon does not cleaned up correctly.")
+        """Remove the temporary xml cache"""
+        if not cls.keep_cache:
+            del os.environ["GRASS_WCS_CACHE_DIR"]
+            shutil.rmtree(cls.cache_dir)
+        elif cls.cache_expire is None:
+            del os.environ["GRASS_WCS_CACHE_EXPIRE"]
+        else:
+            os.environ["GRASS_WCS_CACHE_EXPIRE"] = cls.cache_expire
 
-    # pylint: disable=invalid-name
-    def tearDown(self):
-        """Remove the outputs created
-        This is executed after each test run.
-        """
-        if grass.find_file(name=self.out, element="raster")["file"]:
-            self.runModule(
-                "g.remove",
-                type="raster",
-                name=f"{self.out}",
-                flags="f",
-            )
+
+class TestRInWcsMetadata(RInWcsTestCase):
+    """Test class for the r.in.wcs metadata requests; the tests only read
+    from the WCS and do not change the mapset or the region, so they can
+    run in parallel"""
+
+    num_coverage_ids = 11
+    coverage_name = "Worldpop 2020 1km aggregated UNadj Pop. density"
+    # coverage id and name in the DescribeCoverage stdout, found in one scan
+    describe_re = re.compile(
+        re.escape(RInWcsTestCase.coverageid)
+        + ".*?"
+        + re.escape(coverage_name),
+        re.S,
+    )
+    _caps = None
+
+    def _capabilities_xml(self):
+        """Returns the GetCapabilities xml printed by r.in.wcs -c without the
+        leading "GetCapabilities of <url>:" line; the module is only run once
+        for all tests"""
+        if TestRInWcsMetadata._caps is None:
+            r_check = SimpleModule("r.in.wcs", url=self.url, flags="c")
+            self.assertModule(r_check, "GetCapabilities fails.")
+            stdout = r_check.outputs.stdout
+            TestRInWcsMetadata._caps = stdout.partition("\n")[2]
+        return TestRInWcsMetadata._caps
+
+    def _iter_coverage_ids(self):
+        """Yields the CoverageIds of the GetCapabilities xml one by one,
+        parsed incrementally so a test can stop at the first match"""
+        xml_str = self._capabilities_xml()
+        for _event, elem in etree.iterparse(
+            BytesIO(xml_str.encode("utf-8")),
+            tag="{http://www.opengis.net/wcs/2.0}CoverageId",
+        ):
+            yield elem.text
+            elem.clear()
 
     def test_getcapabilities(self):
         """
         Tests GetCapabilities
         """
         print("\nTest GetCapabilities ...")
-        r_check = SimpleModule(
-            "r.in.wcs",
-            url=self.url,
-            flags="c",
-        )
-        self.assertModule(r_check, "GetCapabilities fails.")
-        stdout = r_check.outputs.stdout
         self.assertIn(
             self.coverageid,
-            stdout,
+            self._iter_coverage_ids(),
             "Coverage not in xml GetCapabilities stdout",
         )
         print("Test GetCapabilities successfully finished.\n")
@@ -129,6 +152,14 @@ class TestRInWcs(TestCase):
             self.num_coverage_ids,
             f"Length of the coverage id list not {self.num_coverage_ids}.",
         )
+        # the list has one line per CoverageId of GetCapabilities
+        num_caps_ids = sum(1 for _cid in self._iter_coverage_ids())
+        self.assertEqual(
+            num_caps_ids,
+            self.num_coverage_ids - 1,
+            "Number of CoverageIds in GetCapabilities not "
+            f"{self.num_coverage_ids - 1}.",
+        )
         print("Test list coverage ids successfully finished.\n")
 
     def test_describe_coverage(self):
@@ -144,18 +175,109 @@ class TestRInWcs(TestCase):
         )
         self.assertModule(r_check, "DescribeCoverage fails.")
         stdout = r_check.outputs.stdout
-        self.assertIn(
-            self.coverageid,
+        self.assertRegex(
             stdout,
-            "Coverage id not in xml DescribeCoverage stdout",
-        )
-        self.assertIn(
-            self.coverage_name,
-            stdout,
-            "Coverage name not in xml DescribeCoverage stdout",
+            self.describe_re,
+            "Coverage id or name not in xml DescribeCoverage stdout",
         )
         print("Test DescribeCoverage successfully finished.\n")
 
+    def test_credentials_not_printed(self):
+        """
+        Tests that resolving the credentials does not print them
+        """
+        print("\nTest credentials not printed ...")
+        sys.path.append(
+            get_lib_path(modname="r.in.wcs", libname="r_in_wcs_lib")
+        )
+        # pylint: disable=import-outside-toplevel,no-name-in-module
+        from r_in_wcs_lib import get_credentials
+
+        pw_env = f"R_IN_WCS_TEST_PW_{self.pid}"
+        password = f"r_in_wcs_secret_{self.pid}"
+        os.environ[pw_env] = password
+        stdout = StringIO()
+        try:
+            with redirect_stdout(stdout):
+                auth = get_credentials("r_in_wcs_user", pw_env)
+        finally:
+            del os.environ[pw_env]
+        self.assertEqual(
+            auth,
+            ("r_in_wcs_user", password),
+            "Credentials not resolved from environment variable",
+        )
+        self.assertNotIn(
+            password,
+            stdout.getvalue(),
+            "Password printed to stdout",
+        )
+        print("Test credentials not printed successfully finished.\n")
+
+
+class TestRInWcsImport(RInWcsTestCase):
+    """Test class for the r.in.wcs data import"""
+
+    region = f"r_in_wcs_orig_region_{RInWcsTestCase.pid}"
+    out = f"r_in_wcs_test_output_{RInWcsTestCase.pid}"
+    out_tiled = f"r_in_wcs_test_output_tiled_{RInWcsTestCase.pid}"
+    # small enough to split the test region into several tiles
+    tile_size = 500
+    north = 186650
+    south = 185425
+    west = 172622
+    east = 174012
+    num_data = None
+
+    @classmethod
+    # pylint: disable=invalid-name
+    def setUpClass(cls):
+        """Ensures expected computational region"""
+        super().setUpClass()
+        cls.num_data = len(
+            grass.parse_command("g.list", type="all", mapset=".")
+        )
+        # set region
+        cls.runModule("g.region", save=cls.region)
+        cls.runModule(
+            "g.region",
+            n=cls.north,
+            s=cls.south,
+            w=cls.west,
+            e=cls.east,
+            res=1,
+        )
+
+    @classmethod
+    # pylint: disable=invalid-name
+    def tearDownClass(cls):
+        """Remove the temporary region and generated data"""
+        super().tearDownClass()
+        cls.runModule("g.region", region=cls.region)
+        cls.runModule("g.remove", type="region", name=cls.region, flags="f")
+        # check number of data in mapset
+        num_data = len(grass.parse_command("g.list", type="all", mapset="."))
+        if num_data != cls.num_data:
+            cls.fail(cls, "Test or addon does not cleaned up correctly.")
+
+    # pylint: disable=invalid-name
+    def tearDown(self):
+        """Remove the outputs created
+        This is executed after each test run.
+        """
+        # one g.remove instead of a find_file per output; g.remove only
+        # warns about maps which do not exist
+        with open(os.devnull, "w", encoding="utf-8") as nuldev:
+            grass.run_command(
+                "g.remove",
+                type="raster",
+                name=f"{self.out},{self.out_tiled}",
+                flags="f",
+                quiet=True,
+                stderr=nuldev,
+                errors="ignore",
+            )
+
     def test_data_import(self):
         """
         Tests data import
@@ -186,6 +308,72 @@ class TestRInWcs(TestCase):
         )
         print("Test data import successfully finished.\n")
 
+    def test_data_import_tiled(self):
+        """
+        Tests data import with forced tiling against the import of the whole
+        region, with the thread pool, the process pool (-w) and asyncio (-a)
+        """
+        print("\nTest tiled data import ...")
+        r_check = SimpleModule(
+            "r.in.wcs",
+            url=self.url,
+            coverageid=self.coverageid,
+            output=self.out,
+        )
+        self.assertModule(r_check, "data import of the whole region fails.")
+        ref_univar = grass.parse_command("r.univar", map=self.out, flags="g")
+        reference = {key: float(ref_univar[key]) for key in ("min", "max")}
+        ref_info = grass.parse_command("r.info", map=self.out, flags="g")
+        region = grass.region()
+        for flags in ("t", "tw", "ta"):
+            with self.subTest(flags=flags):
+                if "a" in flags and not all(
+                    importlib.util.find_spec(lib)
+                    for lib in ("aiohttp", "aiofiles")
+                ):
+                    self.skipTest("aiohttp or aiofiles not installed")
+                r_check = SimpleModule(
+                    "r.in.wcs",
+                    url=self.url,
+                    coverageid=self.coverageid,
+                    output=self.out_tiled,
+                    tile_size=self.tile_size,
+                    nprocs=8,
+                    flags=flags,
+                    overwrite=True,
+                )
+                self.assertModule(
+                    r_check, f"Tiled data import -{flags} fails."
+                )
+                self.assertRasterFitsUnivar(
+                    self.out_tiled, reference=reference, precision=1e-4
+                )
+                # the tiles are patched in the current region, which covers
+                # the import of the whole region
+                info = grass.parse_command(
+                    "r.info", map=self.out_tiled, flags="g"
+                )
+                for key in ("north", "south", "east", "west"):
+                    self.assertAlmostEqual(
+                        float(info[key]),
+                        region[key[0]],
+                        places=4,
+                        msg=f"{key} of tiled output raster not the region",
+                    )
+                self.assertTrue(
+                    (
+                        float(info["north"]) >= float(ref_info["north"])
+                        and float(ref_info["south"]) >= float(info["south"])
+                        and float(info["east"]) >= float(ref_info["east"])
+                        and float(ref_info["west"]) >= float(info["west"])
+                    ),
+                    "Tiled output does not cover the whole region import",
+                )
+                self.runModule(
+                    "g.remove", type="raster", name=self.out_tiled, flags="f"
+                )
+        print("Test tiled data import successfully finished.\n")
+
 
 if __name__ == "__main__":
     test()